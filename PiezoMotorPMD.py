@@ -1,17 +1,21 @@
 import socket
 import queue
 import time
-from threading import Thread, Lock, Event, Condition
+from threading import Thread, Lock
 
 import tango
 from tango import DeviceClass, DevState, DevFailed
 from tango.server import Device, attribute, command, device_property
 
+from io_reactor import get_reactor, ReactorLock
+from wire_capture import WireRecorder, DIR_TX, DIR_RX, DEFAULT_MAX_BYTES, DEFAULT_BACKUPS
+
 ATTR_UPDATE_DELAY = 0.0001  # Attribute update period
-SEND_REQ_DELAY = 0.001
 TIMEOUT = 1
 POS_TOLERANCE = 0.1
 JOG_STEPS_N = 32
+GROUP_POLL_DELAY = 0.01
+GROUP_TIMEOUT_MARGIN = 5
 
 
 
@@ -23,6 +27,10 @@ class PiezoMotorPMDCtrl(Device):
     enc_res = device_property(dtype=float, default_value=1) # Encoder resolution in nm
     enc_sign = device_property(dtype=int, default_value=-1)
     max_step_rate = device_property(dtype=int, default_value=972)
+    wfm_step_size = device_property(dtype=float, default_value=3.5) # Travel per wfm-step in micron
+    wire_capture_path = device_property(dtype=str, default_value="") # Empty disables the recorder
+    wire_capture_max_bytes = device_property(dtype=int, default_value=DEFAULT_MAX_BYTES)
+    wire_capture_backups = device_property(dtype=int, default_value=DEFAULT_BACKUPS)
 
 
     status_table = {
@@ -74,9 +82,21 @@ class PiezoMotorPMDCtrl(Device):
 
     index = attribute(dtype=bool, access=tango.AttrWriteType.READ_WRITE,
                         label="Index Found")
+
+    group_in_pos = attribute(dtype=bool, access=tango.AttrWriteType.READ,
+                        label="Group InPos")
+
+    group_sync = attribute(dtype=bool, access=tango.AttrWriteType.READ_WRITE,
+                        label="Group Sync Velocity")
     
 
 
+    # Devices of this server process by lower-case name, used by GroupMove
+    _instances = {}
+    # Axes taking part in a GroupMove that has not completed yet
+    _group_axes = set()
+    _group_lock = Lock()
+
     def __init__(self, *args, **kwargs):
         print("Executing __init__")
         super().__init__(*args, **kwargs)
@@ -98,16 +118,37 @@ class PiezoMotorPMDCtrl(Device):
         self._status_ctrl = ""
         self._in_pos = False
         self._index = False
+        self._status_seq = 0
+        self._group_in_pos = True
+        self._group_sync = True
+        self._group_move_thread = None
+        self._poll_request = None
+        self._poll_start = 0.0
+        self._poll_deadline = 0.0
+        self._next_poll = 0.0
 
         # Queues for communication between threads
         self.write_queue = queue.Queue()
         self.read_queue = queue.Queue()
 
-        # Lock for socket access
-        self.socket_lock = Lock()
-        self.acq_lock = Lock()
+        # Socket I/O and attribute polling are served by the process-wide reactor
+        self.reactor = get_reactor()
+
+        # Lock for request/reply exchanges, one outstanding request at a time
+        self.acq_lock = ReactorLock(self.reactor, self)
+
+        # Optional recorder of the raw socket traffic
+        self.wire_recorder = None
+        if self.wire_capture_path:
+            try:
+                self.wire_recorder = WireRecorder(self.wire_capture_path,
+                                                  self.wire_capture_max_bytes,
+                                                  self.wire_capture_backups)
+            except (OSError, ValueError) as e:
+                print(f"Unable to open wire capture file: {e}")
 
         # Connect to the serial-to-Ethernet device
+        self.sock = None
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.moxa_host, self.moxa_port))
@@ -115,61 +156,85 @@ class PiezoMotorPMDCtrl(Device):
             print(f"Unable to connect to the moxa device: {e}")
             return
 
-        # Start the reading and writing threads
-        self.read_thread = Thread(target=self.read_from_socket, args=(self.sock,), daemon=True)
-        self.write_thread = Thread(target=self.write_to_socket, args=(self.sock,), daemon=True)
-        
-        self.read_thread.start()
-        self.write_thread.start()
+        self.reactor.register(self, self.sock)
+
+        PiezoMotorPMDCtrl._instances[self.get_name().lower()] = self
 
         print("Initializing PiezoMotorPMDCtrl device...")
         # self.info_stream("PiezoMotorPMDCtrl device initialized")
 
-        
-        # Attr update thread
-        self._stop_attr_update_thread = Event()
-        self._attr_update_thread = Thread(target=self._update_attributes, args=(self,))
-        self._attr_update_thread.start()
-
         self.write_step_rate(self.max_step_rate)
         self._switch_ext_limit()
         
     
-    def read_from_socket(self, sock):
-        while True:
-            try:
-                data = sock.recv(1024)
-                if data:
-                    with self.socket_lock:
-                        self.read_queue.put(data.decode('utf-8'))
-            except socket.error as e:
-                print(f"Socket error: {e}")
-                break
-
-    def write_to_socket(self, sock):
-        while True:
-            if not self.write_queue.empty():
-                data = self.write_queue.get()
-                with self.socket_lock:
-                    try:
-                        formatted_request = f"{data}\n"
-                        request_bytes = formatted_request.encode('utf-8')
-                        sock.sendall(request_bytes)
-                    except socket.error as e:
-                        print(f"Socket error: {e}")
-                        break
-    
-    def _update_attributes(self, main_thread):
-        while not main_thread._stop_attr_update_thread.is_set():
-            start_time = time.time()
-            # Update the position attribute from hardware
-            self._read_hw_enc_pos()
-            self._read_ctrl_stat()
-            
-            #print("Length of the self.write_queue: ", self.write_queue.qsize())
-            # Sleep for a specified period before the next update
-            time.sleep(ATTR_UPDATE_DELAY)
-            self._update_rate = (time.time() - start_time) * 1000
+    # Reactor callbacks, all of them run in the reactor thread
+    def read_from_socket(self, data):
+        if self.wire_recorder is not None:
+            self.wire_recorder.record(DIR_RX, data)
+        resp = data.decode('utf-8', errors='replace')
+        if self._poll_request is not None:
+            self._poll_reply(resp)
+        else:
+            self.read_queue.put(resp)
+
+    def write_to_socket(self, data):
+        formatted_request = f"{data}\n"
+        request_bytes = formatted_request.encode('utf-8')
+        if self.wire_recorder is not None:
+            self.wire_recorder.record(DIR_TX, request_bytes)
+        self.reactor.send(self.sock, request_bytes)
+
+    def socket_error(self, e):
+        print(f"Socket error: {e}")
+        # The channel is no longer serviced, so an ongoing poll never times out
+        if self._poll_request is not None:
+            self._poll_request = None
+            self.acq_lock.release()
+        self.set_state(DevState.UNKNOWN)
+        self.previous_state = DevState.UNKNOWN
+
+    def service(self, now):
+        while not self.write_queue.empty():
+            self.write_to_socket(self.write_queue.get())
+        return self._update_attributes(now)
+
+    def _update_attributes(self, now):
+        # Polls the encoder position and the controller status one request
+        # at a time, holding acq_lock like any other request
+        if self._poll_request is None:
+            if now < self._next_poll:
+                return self._next_poll
+            if not self.acq_lock.acquire_or_notify():
+                # Woken up again when the lock is released
+                return None
+            self._poll_start = now
+            self._poll_send("X0E", now)
+        elif now > self._poll_deadline:
+            self.set_state(DevState.UNKNOWN)
+            self.previous_state = DevState.UNKNOWN
+            self._poll_done(now)
+            return self._next_poll
+        return self._poll_deadline
+
+    def _poll_send(self, request, now):
+        self._poll_request = request
+        self._poll_deadline = now + TIMEOUT
+        self.write_to_socket(request)
+
+    def _poll_reply(self, resp):
+        now = time.monotonic()
+        if self._poll_request == "X0E":
+            self._read_hw_enc_pos(resp)
+            self._poll_send("X0U4", now)
+        else:
+            self._read_ctrl_stat(resp)
+            self._update_rate = (now - self._poll_start) * 1000
+            self._poll_done(now)
+
+    def _poll_done(self, now):
+        self._poll_request = None
+        self._next_poll = now + ATTR_UPDATE_DELAY
+        self.acq_lock.release()
     
     def always_executed_hook(self):
         with self.acq_lock:
@@ -212,22 +277,19 @@ class PiezoMotorPMDCtrl(Device):
         if self._ext_lim:
             self.set_state(DevState.ALARM)
 
-    def _read_hw_enc_pos(self):
+    def _read_hw_enc_pos(self, resp):
         try:
-            with self.acq_lock:
-                resp = self.send_request("X0E")
-                enc_resp = resp.split(':')
-                self._enc_pos = int(enc_resp[1].strip())
+            enc_resp = resp.split(':')
+            self._enc_pos = int(enc_resp[1].strip())
         except Exception as e:
             print(f"Error reading encoder position: {e}")
             self.error_stream(f"Error reading encoder position: {e}")
 
-    def _read_ctrl_stat(self):
+    def _read_ctrl_stat(self, resp):
         try:
-            with self.acq_lock:
-                resp = self.send_request("X0U4")
-                status_ctrl_resp = resp.split(':')
-                self._status_ctrl = str(status_ctrl_resp[1].strip())
+            status_ctrl_resp = resp.split(':')
+            self._status_ctrl = str(status_ctrl_resp[1].strip())
+            self._status_seq += 1
         except Exception as e:
             print(f"Error reading ctrl status: {e}")
             self.error_stream(f"Error reading ctrl status: {e}")
@@ -242,7 +304,7 @@ class PiezoMotorPMDCtrl(Device):
         return self._position
 
     def write_position(self, value):
-        pos = round(value / (self.enc_res * self.enc_sign * 1e-3))
+        pos = self._target_counts(value)
         self.set_state(DevState.MOVING)
         # self.previous_state = DevState.MOVING
         try:
@@ -333,20 +395,26 @@ class PiezoMotorPMDCtrl(Device):
     def write_index(self, value):
         self._index = False
 
+    def read_group_in_pos(self):
+        return self._group_in_pos
+
+    def read_group_sync(self):
+        return self._group_sync
+
+    def write_group_sync(self, value):
+        self._group_sync = value
+
     def send_request(self, request):
         try:
-            start_time = time.time()
             self.write_queue.put(request)
+            self.reactor.mark_ready(self)
 
-            while self.read_queue.empty():
-                time.sleep(SEND_REQ_DELAY)
-                elapsed_time = time.time() - start_time
-                if elapsed_time > TIMEOUT:
-                    self.set_state(DevState.UNKNOWN)
-                    self.previous_state = DevState.UNKNOWN
-                    return
-
-            received_data = self.read_queue.get()
+            try:
+                received_data = self.read_queue.get(timeout=TIMEOUT)
+            except queue.Empty:
+                self.set_state(DevState.UNKNOWN)
+                self.previous_state = DevState.UNKNOWN
+                return
             return received_data
             
         except ConnectionError as e:
@@ -362,6 +430,145 @@ class PiezoMotorPMDCtrl(Device):
             print(f"Failed to send data: {e}")
 
 
+    def _target_counts(self, value):
+        return round(value / (self.enc_res * self.enc_sign * 1e-3))
+
+    @command(dtype_in=tango.DevVarDoubleStringArray,
+             doc_in="Target positions (micron) and names of the devices to move together")
+    def GroupMove(self, argin):
+        targets, names = argin
+        if len(targets) != len(names):
+            raise ValueError("GroupMove needs one target position per device name")
+        if not names:
+            raise ValueError("GroupMove needs at least one device")
+        if len({name.lower() for name in names}) != len(names):
+            raise ValueError("GroupMove got the same device more than once")
+        axes = []
+        for name in names:
+            axis = PiezoMotorPMDCtrl._instances.get(name.lower())
+            if axis is None:
+                raise ValueError(f"Device {name} is not served by this process")
+            axes.append(axis)
+
+        with PiezoMotorPMDCtrl._group_lock:
+            if self._group_move_thread is not None and self._group_move_thread.is_alive():
+                raise ValueError("A GroupMove started by this device is still pending")
+            busy = [axis.get_name() for axis in axes if axis in PiezoMotorPMDCtrl._group_axes]
+            if busy:
+                raise ValueError(f"{', '.join(busy)} already part of a pending GroupMove")
+            PiezoMotorPMDCtrl._group_axes.update(axes)
+
+        saved_rates = {}
+        try:
+            # Prepare everything that is not time critical before the burst
+            distances = [abs(target - axis.read_position()) for axis, target in zip(axes, targets)]
+            rates = [max(axis._step_rate, 1) for axis in axes]
+            times = [dist / (axis.wfm_step_size * rate) for axis, dist, rate in zip(axes, distances, rates)]
+            if self._group_sync:
+                duration = max(times)
+                if duration > 0:
+                    for i, axis in enumerate(axes):
+                        if distances[i] == 0:
+                            continue
+                        rate = max(1, round(distances[i] / (axis.wfm_step_size * duration)))
+                        if rate != axis._step_rate:
+                            saved_rates[axis] = axis._step_rate
+                            axis.write_step_rate(rate)
+                            rates[i] = rate
+            expected = max(dist / (axis.wfm_step_size * rate) for axis, dist, rate in zip(axes, distances, rates))
+            deadline = time.monotonic() + 2 * expected + GROUP_TIMEOUT_MARGIN
+            # Axes sharing a Moxa link are sent one after another
+            order = sorted(range(len(axes)), key=lambda i: (axes[i].moxa_host, axes[i].moxa_port))
+            burst = [(axes[i], f'X0T{axes[i]._target_counts(targets[i])}') for i in order]
+
+            self._group_in_pos = False
+            locks = sorted({axis.get_name(): axis.acq_lock for axis in axes}.items())
+            for _, lock in locks:
+                lock.acquire()
+            try:
+                for axis in axes:
+                    axis.set_state(DevState.MOVING)
+                seqs = {axis: axis._status_seq for axis in axes}
+                # Written by the reactor in a single callback
+                get_reactor().call_soon(PiezoMotorPMDCtrl._send_burst, burst)
+                # Every reply is taken, so none is left for the next request
+                for axis, _ in burst:
+                    try:
+                        received_data = axis.read_queue.get(timeout=TIMEOUT)
+                    except queue.Empty:
+                        axis.set_state(DevState.UNKNOWN)
+                        axis.previous_state = DevState.UNKNOWN
+                        continue
+                    try:
+                        if received_data.strip()[-1] == '!':
+                            axis.previous_state = DevState.ALARM
+                    except Exception as e:
+                        self.error_stream(f"Error in GroupMove reply of {axis.get_name()}: {e}")
+            finally:
+                for _, lock in reversed(locks):
+                    lock.release()
+
+            self._group_move_thread = Thread(target=self._wait_group_move,
+                                             args=(axes, seqs, saved_rates, deadline), daemon=True)
+            self._group_move_thread.start()
+        except Exception:
+            for axis, rate in saved_rates.items():
+                axis.write_step_rate(rate)
+            with PiezoMotorPMDCtrl._group_lock:
+                PiezoMotorPMDCtrl._group_axes.difference_update(axes)
+            raise
+
+    @staticmethod
+    def _send_burst(burst):
+        for axis, request in burst:
+            axis.write_to_socket(request)
+
+    def _wait_group_move(self, axes, seqs, saved_rates, deadline):
+        # Completes only once every axis reports targetReached
+        try:
+            aborted = not self._wait_group_axes(axes, seqs, deadline)
+        finally:
+            for axis, rate in saved_rates.items():
+                axis.write_step_rate(rate)
+            with PiezoMotorPMDCtrl._group_lock:
+                PiezoMotorPMDCtrl._group_axes.difference_update(axes)
+        self._group_in_pos = not aborted
+
+    def _wait_group_axes(self, axes, seqs, deadline):
+        pending = list(axes)
+        last_seqs = dict(seqs)
+        last_update = {axis: time.monotonic() for axis in pending}
+        while pending:
+            time.sleep(GROUP_POLL_DELAY)
+            now = time.monotonic()
+            if now > deadline:
+                self.error_stream(f"GroupMove timed out waiting for {', '.join(axis.get_name() for axis in pending)}")
+                return False
+            still_moving = []
+            for axis in pending:
+                if axis._status_seq != last_seqs[axis]:
+                    last_seqs[axis] = axis._status_seq
+                    last_update[axis] = now
+                elif now - last_update[axis] > 2 * TIMEOUT:
+                    self.error_stream(f"GroupMove aborted, no status from {axis.get_name()}")
+                    return False
+                # Skip status reads that may predate the target command
+                if axis._status_seq < seqs[axis] + 2:
+                    still_moving.append(axis)
+                    continue
+                with axis.acq_lock:
+                    first_double = axis._status_ctrl.split(',')[0]
+                ctrl_status = axis.decode_status_bits(first_double)
+                if 'targetReached' in ctrl_status:
+                    continue
+                if ('xLimit' in ctrl_status or 'parked' in ctrl_status or 'targetMode' not in ctrl_status
+                        or any(elem in self.status_table['d1'] for elem in ctrl_status)):
+                    self.error_stream(f"GroupMove aborted, {axis.get_name()} reports {', '.join(ctrl_status)}")
+                    return False
+                still_moving.append(axis)
+            pending = still_moving
+        return True
+
     @command
     def Start(self):
         print("Changing state")
@@ -480,11 +687,13 @@ class PiezoMotorPMDCtrl(Device):
         except Exception as e:
             self.error_stream(f"Error stopping motor during delete_device: {e}")
         finally:
-            self._socket_thread.stop()
-            self._socket_thread.join()
+            PiezoMotorPMDCtrl._instances.pop(self.get_name().lower(), None)
+
+            if self.wire_recorder is not None:
+                self.wire_recorder.close()
 
-            self._stop_attr_update_thread.set()
-            self._attr_update_thread.join()
+            if self.sock is not None:
+                self.reactor.unregister(self.sock)
 
             Device.delete_device(self)
 
@@ -509,6 +718,10 @@ class PiezoMotorPMDCtrlClass(DeviceClass):
         'moxa_host': [tango.DevString, "IP Address of the Moxa IP/serial hub", []],
         'moxa_port': [tango.DevShort, "Port of the Moxa IP/serial hub", []],
         'moxa_reconnect_delay': [tango.DevFloat, "Timeout before reconnecting attempt", []],   
+        'wfm_step_size': [tango.DevDouble, "Travel per wfm-step in micron, used by GroupMove", []],
+        'wire_capture_path': [tango.DevString, "File to record the socket traffic to, empty to disable", []],
+        'wire_capture_max_bytes': [tango.DevLong, "Size at which the wire capture file is rotated", []],
+        'wire_capture_backups': [tango.DevShort, "Number of rotated wire capture files to keep", []],
     }
 
     # Device Class Commands
@@ -521,6 +734,7 @@ class PiezoMotorPMDCtrlClass(DeviceClass):
         'UnPark': [[tango.DevVoid, "Unpark the motor"], [tango.DevVoid, ""]],
         'CheckVelocity': [[tango.DevDouble, "Estimates Velocity"], [tango.DevDouble, ""]],
         'GetSPC': [[tango.DevVoid, "Get SPC"], [tango.DevVoid, ""]],
+        'GroupMove': [[tango.DevVarDoubleStringArray, "Move several axes together"], [tango.DevVoid, ""]],
     }
 
     # Device Class Attributes
@@ -539,6 +753,8 @@ class PiezoMotorPMDCtrlClass(DeviceClass):
         'ext_lim': [[tango.DevBoolean, tango.SCALAR, tango.READ]],
         'script': [[tango.DevBoolean, tango.SCALAR, tango.READ]],
         'index': [[tango.DevBoolean, tango.SCALAR, tango.READ_WRITE]],
+        'group_in_pos': [[tango.DevBoolean, tango.SCALAR, tango.READ]],
+        'group_sync': [[tango.DevBoolean, tango.SCALAR, tango.READ_WRITE]],
     }
 
 # Run the server
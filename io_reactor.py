@@ -0,0 +1,252 @@
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from threading import Thread, Lock
+
+RECV_SIZE = 1024
+
+
+class IOReactor:
+    """Single selector loop serving the sockets of many devices.
+
+    A channel is any object with the methods ``read_from_socket(data)``,
+    ``socket_error(exc)`` and ``service(now)``, registered together with its
+    socket. ``service`` is called from the reactor thread only when the
+    channel is ready, i.e. it received data or was passed to ``mark_ready``,
+    or when the deadline it returned last time is due. It returns the
+    monotonic time it wants to be serviced again at, or None. A pass of the
+    loop therefore costs in proportion to the traffic, not to the number of
+    channels. All socket operations happen in the reactor thread. Errors
+    raised by a channel are logged and never stop the loop.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._channels = {}
+        self._socks = {}
+        self._out = {}
+        self._calls = collections.deque()
+        self._ready = collections.deque()
+        # Deadlines as (time, seq, channel), entries not matching _due are stale
+        self._timers = []
+        self._due = {}
+        self._seq = itertools.count()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = Thread(target=self._run, name="IOReactor", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The loop has wake-ups pending already
+            pass
+
+    def call_soon(self, callback, *args):
+        self._calls.append((callback, args))
+        self.wake()
+
+    def mark_ready(self, channel):
+        """Have ``channel`` serviced on the next pass of the loop."""
+        self._ready.append(channel)
+        if threading.get_ident() != self._thread.ident:
+            self.wake()
+
+    def register(self, channel, sock):
+        self.call_soon(self._register, channel, sock)
+
+    def unregister(self, sock):
+        """Stop serving ``sock`` and close it."""
+        self.call_soon(self._unregister, sock, True)
+
+    def _register(self, channel, sock):
+        if sock in self._channels:
+            return
+        try:
+            sock.setblocking(False)
+            self._selector.register(sock, selectors.EVENT_READ, channel)
+        except (OSError, ValueError) as e:
+            self._call(channel, channel.socket_error, e)
+            return
+        self._channels[sock] = channel
+        self._socks[channel] = sock
+        self._out[sock] = bytearray()
+        self._ready.append(channel)
+
+    def _unregister(self, sock, close=False):
+        channel = self._channels.pop(sock, None)
+        if channel is not None:
+            del self._out[sock]
+            if self._socks.get(channel) is sock:
+                del self._socks[channel]
+                self._due.pop(channel, None)
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        if close:
+            sock.close()
+
+    def send(self, sock, data):
+        # Only to be called from the reactor thread, e.g. from service()
+        out = self._out.get(sock)
+        if out is None:
+            return
+        was_empty = not out
+        out += data
+        if was_empty:
+            self._flush(sock)
+
+    def _flush(self, sock):
+        out = self._out[sock]
+        try:
+            sent = sock.send(out)
+            del out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self._fail(sock, e)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if out else 0)
+        self._selector.modify(sock, events, self._channels[sock])
+
+    def _fail(self, sock, exc):
+        channel = self._channels.get(sock)
+        self._unregister(sock)
+        if channel is not None:
+            self._call(channel, channel.socket_error, exc)
+
+    def _call(self, channel, callback, *args):
+        try:
+            return callback(*args)
+        except Exception as e:
+            print(f"Error in {callback.__name__} of {channel}: {e}")
+
+    def _run(self):
+        timeout = None
+        while True:
+            ready = set()
+            for key, mask in self._selector.select(timeout):
+                sock, channel = key.fileobj, key.data
+                if channel is None:
+                    try:
+                        while self._wake_r.recv(RECV_SIZE):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                if sock not in self._channels:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(sock)
+                if mask & selectors.EVENT_READ and sock in self._channels:
+                    try:
+                        data = sock.recv(RECV_SIZE)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        self._fail(sock, e)
+                        continue
+                    if not data:
+                        self._fail(sock, ConnectionResetError("Connection closed by peer"))
+                        continue
+                    self._call(channel, channel.read_from_socket, data)
+                    ready.add(channel)
+
+            while self._calls:
+                callback, args = self._calls.popleft()
+                self._call(self, callback, *args)
+            while self._ready:
+                ready.add(self._ready.popleft())
+
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                due, _, channel = heapq.heappop(self._timers)
+                if self._due.get(channel) == due:
+                    del self._due[channel]
+                    ready.add(channel)
+
+            for channel in ready:
+                if channel not in self._socks:
+                    continue
+                due = self._call(channel, channel.service, now)
+                if due is None:
+                    continue
+                # Keep the earliest deadline, a later one is asked for again then
+                current = self._due.get(channel)
+                if current is None or due < current:
+                    self._due[channel] = due
+                    heapq.heappush(self._timers, (due, next(self._seq), channel))
+            if len(self._timers) > 2 * len(self._due) + 64:
+                # Mostly stale entries, rebuild from the live deadlines
+                self._timers = [(due, next(self._seq), channel) for channel, due in self._due.items()]
+                heapq.heapify(self._timers)
+
+            if self._ready or self._calls:
+                timeout = 0.0
+            elif self._timers:
+                timeout = max(0.0, self._timers[0][0] - time.monotonic())
+            else:
+                timeout = None
+
+
+class ReactorLock:
+    """Lock whose release marks its channel ready if the channel waits for it.
+
+    The reactor never blocks on a lock: the channel calls
+    ``acquire_or_notify`` and, if the lock is taken, is serviced again after
+    the next ``release``.
+    """
+
+    def __init__(self, reactor, channel):
+        self._lock = Lock()
+        self._reactor = reactor
+        self._channel = channel
+        self._waiting = False
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._lock.acquire(blocking, timeout)
+
+    def acquire_or_notify(self):
+        # Flag first, so a release racing with the attempt still wakes the reactor
+        self._waiting = True
+        if self._lock.acquire(blocking=False):
+            self._waiting = False
+            return True
+        return False
+
+    def release(self):
+        self._lock.release()
+        if self._waiting:
+            self._waiting = False
+            self._reactor.mark_ready(self._channel)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+_reactor = None
+_reactor_lock = Lock()
+
+
+def get_reactor():
+    """Return the reactor shared by every device of this process."""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = IOReactor()
+        return _reactor
@@ -0,0 +1,329 @@
+import os
+import socket
+import struct
+import sys
+import time
+from threading import Thread, Lock, Event
+
+# Capture file layout:
+#   FILE_MAGIC, then records of RECORD_HEADER followed by the raw payload.
+#   RECORD_HEADER = monotonic timestamp (s, float64), direction (uint8),
+#                   payload length (uint32), little endian.
+FILE_MAGIC = b'PMDWIRE1'
+RECORD_HEADER = struct.Struct('<dBI')
+
+DIR_TX = 0  # Request written to the Moxa socket
+DIR_RX = 1  # Reply read from the Moxa socket
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+FLUSH_INTERVAL = 0.05  # Longest time a record stays in memory, in s
+
+# Capture files currently held open by a recorder of this process
+_paths_in_use = set()
+_paths_lock = Lock()
+
+
+class WireRecorder:
+    """Append-only binary log of the raw traffic on a Moxa socket.
+
+    The active file is rotated to ``<path>.1`` .. ``<path>.<backups>`` once it
+    grows beyond ``max_bytes``, so the total disk usage stays bounded.
+    ``record`` only queues the record in memory; the file is written, flushed
+    and rotated every ``FLUSH_INTERVAL`` by a writer thread shared by all
+    recorders, so the socket I/O never waits on the disk. Any error while
+    writing disables the recorder. A file can only be used by one recorder
+    at a time.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._pending = []
+        self._pending_size = 0
+        self._file = None
+        self._size = 0
+        with _paths_lock:
+            if self.path in _paths_in_use:
+                raise ValueError(f"{self.path} is already used by another wire recorder")
+            _paths_in_use.add(self.path)
+        try:
+            self._open()
+        except OSError:
+            self._release_path()
+            raise
+        _get_writer().add(self)
+
+    def _release_path(self):
+        with _paths_lock:
+            _paths_in_use.discard(self.path)
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write(FILE_MAGIC)
+            self._size = len(FILE_MAGIC)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def record(self, direction, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        header = RECORD_HEADER.pack(time.monotonic(), direction, len(data))
+        with self._lock:
+            if self._file is None:
+                return
+            if self._pending_size > self.max_bytes:
+                # The writer can not keep up, drop rather than grow without bound
+                return
+            self._pending.append(header + data)
+            self._pending_size += len(header) + len(data)
+
+    def write_pending(self):
+        """Write the queued records to the file and flush it."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._pending_size = 0
+        if not pending:
+            return
+        with self._write_lock:
+            if self._file is None:
+                return
+            try:
+                for rec in pending:
+                    if self._size + len(rec) > self.max_bytes and self._size > len(FILE_MAGIC):
+                        self._rotate()
+                    self._file.write(rec)
+                    self._size += len(rec)
+                self._file.flush()
+            except (OSError, ValueError) as e:
+                print(f"Wire recorder disabled, unable to write {self.path}: {e}")
+                self._close_file()
+
+    def _close_file(self):
+        try:
+            if self._file is not None and not self._file.closed:
+                self._file.close()
+        except OSError:
+            pass
+        self._file = None
+        self._release_path()
+        _get_writer().discard(self)
+
+    def close(self):
+        self.write_pending()
+        with self._write_lock:
+            if self._file is not None:
+                self._close_file()
+
+
+class _CaptureWriter:
+    # Single thread writing the queued records of every recorder of the process
+
+    def __init__(self):
+        self._recorders = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="CaptureWriter", daemon=True)
+        self._thread.start()
+
+    def add(self, recorder):
+        with self._lock:
+            self._recorders.add(recorder)
+
+    def discard(self, recorder):
+        with self._lock:
+            self._recorders.discard(recorder)
+
+    def _run(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            with self._lock:
+                recorders = list(self._recorders)
+            for recorder in recorders:
+                recorder.write_pending()
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def _get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _CaptureWriter()
+        return _writer
+
+
+def capture_files(path):
+    """Return the rotated files of a capture, oldest first, ending with ``path``."""
+    files = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        files.append(f"{path}.{i}")
+        i += 1
+    files.reverse()
+    files.append(path)
+    return files
+
+
+def read_capture(path):
+    """Yield ``(timestamp, direction, data)`` for every record in a capture file."""
+    with open(path, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f"{path} is not a PMD wire capture")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, direction, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # Truncated tail, e.g. the server was killed mid-write
+                return
+            yield timestamp, direction, data
+
+
+def read_capture_set(path):
+    """Yield the records of ``path`` and its rotated files as one stream."""
+    for file_path in capture_files(path):
+        yield from read_capture(file_path)
+
+
+class ReplayServer:
+    """Plays a capture back to a single TCP client in place of the Moxa.
+
+    The capture is split into exchanges, a recorded request followed by its
+    replies. Every line received from the client is matched to the earliest
+    recorded request with the same text that has not been replayed yet, so
+    requests issued in a different order than in the capture still get
+    their own replies. The replies of that exchange are sent with their
+    original spacing divided by ``speed``. A ``speed`` of 0 sends the replies
+    without any delay. A line without a matching request is reported and left
+    unanswered.
+    """
+
+    def __init__(self, path, host='127.0.0.1', port=4001, speed=1.0):
+        self.exchanges = self._split_exchanges(read_capture_set(path))
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.mismatches = 0
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sock.bind((self.host, self.port))
+        self.server_sock.listen(1)
+
+    @staticmethod
+    def _split_exchanges(records):
+        exchanges = []
+        for timestamp, direction, data in records:
+            if direction == DIR_TX:
+                exchanges.append((data.rstrip(b'\n'), timestamp, []))
+            elif exchanges:
+                exchanges[-1][2].append((timestamp, data))
+            # Replies before the first request belong to an exchange cut by rotation
+        return exchanges
+
+    @property
+    def address(self):
+        return self.server_sock.getsockname()
+
+    def _sleep_until(self, t_start, t_rec):
+        if self.speed <= 0:
+            return
+        delay = t_rec / self.speed - (time.monotonic() - t_start)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _find(self, request, used, start):
+        for i in range(start, len(self.exchanges)):
+            if not used[i] and self.exchanges[i][0] == request:
+                return i
+        return None
+
+    def serve_once(self):
+        conn, _ = self.server_sock.accept()
+        pending = b''
+        used = [False] * len(self.exchanges)
+        first_unused = 0
+        try:
+            while first_unused < len(self.exchanges):
+                while b'\n' not in pending:
+                    chunk = conn.recv(1024)
+                    if not chunk:
+                        return
+                    pending += chunk
+                line, pending = pending.split(b'\n', 1)
+                t_start = time.monotonic()
+                found = self._find(line, used, first_unused)
+                if found is None:
+                    self.mismatches += 1
+                    print(f"No recorded request {line!r} left in the capture, not answered")
+                    continue
+                used[found] = True
+                while first_unused < len(used) and used[first_unused]:
+                    first_unused += 1
+                _, t_base, replies = self.exchanges[found]
+                # Reply timing is relative to the request that triggered it
+                for timestamp, data in replies:
+                    self._sleep_until(t_start, timestamp - t_base)
+                    conn.sendall(data)
+        finally:
+            conn.close()
+
+    def close(self):
+        self.server_sock.close()
+
+
+def _dump(path):
+    t0 = None
+    for timestamp, direction, data in read_capture_set(path):
+        if t0 is None:
+            t0 = timestamp
+        arrow = '>>' if direction == DIR_TX else '<<'
+        print(f"{(timestamp - t0) * 1000:12.3f} ms {arrow} {data!r}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or replay PMD wire captures")
+    sub = parser.add_subparsers(dest='action', required=True)
+    dump_parser = sub.add_parser('dump', help="Print the records of a capture and its rotated files")
+    dump_parser.add_argument('path')
+    replay_parser = sub.add_parser('replay', help="Serve a capture and its rotated files over local TCP")
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--host', default='127.0.0.1')
+    replay_parser.add_argument('--port', type=int, default=4001)
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help="Timing acceleration factor, 0 for no delays")
+    args = parser.parse_args()
+
+    if args.action == 'dump':
+        _dump(args.path)
+        sys.exit(0)
+
+    server = ReplayServer(args.path, args.host, args.port, args.speed)
+    print(f"Replaying {len(server.exchanges)} exchanges on {args.host}:{args.port}")
+    try:
+        while True:
+            server.serve_once()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()